@@ -1,26 +1,15 @@
 #%%
 import numpy as np 
-import tensorflow as tf 
-
-from sklearn.manifold import TSNE
-import matplotlib.pyplot as plt 
-from tqdm import tqdm 
-
-from models import * 
 
 import sys 
 import pathlib 
-# for LOCAL use 
-sys.path.append(str(pathlib.Path.home()/'Documents/gradschool/672/project/regularization_project'))
-# for COLAB use 
-sys.path.append('/content/')
-# for VIP use 
-sys.path.append('/home/brennan/672/regularization_project/')
-from writers import NeptuneWriter
-
-print("Num GPUs Available: ", len(tf.config.experimental.list_physical_devices('GPU')))
-# tf.enable_eager_execution()
-print(tf.__version__)
+# repo root (writers.py, configs.py)
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from configs import mnist_config
+from artifacts import ArtifactSpool
+
+# tensorflow / the models are imported in the __main__ block: the spawned 
+# artifact workers re-import this module and must not load tf 
 
 #%%
 def get_train_test(batch_size=32):
@@ -47,15 +36,6 @@ def get_train_test(batch_size=32):
 
     return (x_train, y_train), (x_val, y_val), (x_test, y_test)
 
-def log_weights(W, writer):
-    x = TSNE(n_components=2).fit_transform(W.T)
-    for i, xt in enumerate(x): 
-        plt.scatter(xt[0], xt[1], label=str(i))
-    plt.legend()
-    if writer.has_started: 
-        writer.experiment.log_image('TSNE_weights', plt.gcf())
-    plt.clf()
-
 def mean_over_dict(custom_metrics):
     mean_metrics = {}
     for k in custom_metrics.keys(): 
@@ -96,97 +76,109 @@ def record_metrics(w, w_grad, loss, metrics):
 
 
 #%%
-trial_run = False
-config = {
-    'batch_size': 32,
-    'epochs': 200 if not trial_run else 1,
-    'reg_constant': 0.01,
-    'dropout_constant': 0.3,
-}
-(x_train, y_train), (x_val, y_val), (x_test, y_test) = get_train_test()
-
-# default configs 
-trainers = [Baseline, L1Reg, L2Reg, DropoutReg, SpectralReg, OrthogonalReg]
-configs = [config.copy(), config.copy(), config.copy(), config.copy(), config.copy(), config.copy()]
-
-# variations of regularization/dropout parameters 
-new_trainers, new_configs = [], []
-for config, trainer_class in zip(configs, trainers):
-    if trainer_class.__name__ == 'Baseline': 
-        continue
-
-    if trainer_class.__name__ == 'OrthogonalReg':
-        new_confg = config.copy()
-        new_confg['reg_constant'] = 0.1
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
+if __name__ == '__main__':
+    import tensorflow as tf 
+    from models import * 
+
+    trial_run = False
+    from writers import NeptuneWriter
+
+    print("Num GPUs Available: ", len(tf.config.experimental.list_physical_devices('GPU')))
+    # tf.enable_eager_execution()
+    print(tf.__version__)
+
+    config = mnist_config(trial_run)
+    (x_train, y_train), (x_val, y_val), (x_test, y_test) = get_train_test()
+
+    # default configs 
+    trainers = [Baseline, L1Reg, L2Reg, DropoutReg, SpectralReg, OrthogonalReg]
+    configs = [config.copy(), config.copy(), config.copy(), config.copy(), config.copy(), config.copy()]
+
+    # variations of regularization/dropout parameters 
+    new_trainers, new_configs = [], []
+    for config, trainer_class in zip(configs, trainers):
+        if trainer_class.__name__ == 'Baseline': 
+            continue
+
+        if trainer_class.__name__ == 'OrthogonalReg':
+            new_confg = config.copy()
+            new_confg['reg_constant'] = 0.1
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
         
-        new_confg = config.copy()
-        new_confg['reg_constant'] = 0.001
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
+            new_confg = config.copy()
+            new_confg['reg_constant'] = 0.001
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
         
-        new_confg = config.copy()
-        new_confg['reg_constant'] = 0.0001
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
-
-    elif trainer_class.__name__ != 'DropoutReg':
-        new_confg = config.copy()
-        new_confg['reg_constant'] *= 10
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
-
-        new_confg = config.copy()
-        new_confg['reg_constant'] *= 100
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
-
-        new_confg = config.copy()
-        new_confg['reg_constant'] /= 10
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
-
-        new_confg = config.copy()
-        new_confg['reg_constant'] /= 100
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
-    else: 
-        new_confg = config.copy()
-        new_confg['dropout_constant'] = 0.5
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
-
-        new_confg = config.copy()
-        new_confg['dropout_constant'] = 0.8
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
-
-        new_confg = config.copy()
-        new_confg['dropout_constant'] = 0.1
-        new_configs.append(new_confg)
-        new_trainers.append(trainer_class)
+            new_confg = config.copy()
+            new_confg['reg_constant'] = 0.0001
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
+
+        elif trainer_class.__name__ != 'DropoutReg':
+            new_confg = config.copy()
+            new_confg['reg_constant'] *= 10
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
+
+            new_confg = config.copy()
+            new_confg['reg_constant'] *= 100
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
+
+            new_confg = config.copy()
+            new_confg['reg_constant'] /= 10
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
+
+            new_confg = config.copy()
+            new_confg['reg_constant'] /= 100
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
+        else: 
+            new_confg = config.copy()
+            new_confg['dropout_constant'] = 0.5
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
+
+            new_confg = config.copy()
+            new_confg['dropout_constant'] = 0.8
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
+
+            new_confg = config.copy()
+            new_confg['dropout_constant'] = 0.1
+            new_configs.append(new_confg)
+            new_trainers.append(trainer_class)
         
-trainers += new_trainers
-configs += new_configs
+    trainers += new_trainers
+    configs += new_configs
+
+    writer = NeptuneWriter('gebob19/672-mnist')
+
+    if trial_run:
+        trainers = [Baseline]
+        configs = [config]
 
-writer = NeptuneWriter('gebob19/672-mnist')
+    # TSNE + plots of the final weights are rendered by worker processes 
+    spool = ArtifactSpool(pathlib.Path(__file__).resolve().parent/'artifacts', writer.project)
 
-if trial_run:
-    trainers = [Baseline]
-    configs = [config]
+    for config, trainer_class in zip(configs, trainers): 
+        config['experiment_name'] = trainer_class.__name__
+        if not trial_run:
+            writer.start(config)
 
-for config, trainer_class in zip(configs, trainers): 
-    config['experiment_name'] = trainer_class.__name__
-    if not trial_run:
-        writer.start(config)
+        tf.reset_default_graph()
+        full_trainer, W = train(trainer_class(config))
 
-    tf.reset_default_graph()
-    full_trainer, W = train(trainer_class(config))
-    log_weights(W, writer)
-    
-    writer.fin()
+        # stop the experiment now (its stdout capture / monitoring would record 
+        # the next run), the spool re-fetches it by id to attach the image 
+        spool.submit(W, writer.id() if writer.has_started else None)
+        writer.fin()
+        spool.attach_ready()
 
-print('Complete!')
+    spool.close()
+    print('Complete!')
 
 # %%
@@ -0,0 +1,87 @@
+import numpy as np
+import concurrent.futures
+import hashlib
+import multiprocessing as mp
+import os
+import pathlib
+
+# post-run artifacts (TSNE of the weights + plot) rendered in worker processes.
+# the weight matrix is spooled to disk, jobs are keyed by its hash so identical
+# matrices are rendered once, and images are attached to their (already stopped)
+# experiment later, re-fetched by id so no experiment stays open across runs
+#   spool = ArtifactSpool('artifacts', writer.project)
+#   spool.submit(W, writer.id())       # then writer.fin(), training moves on
+#   spool.attach_ready()               # between runs
+#   spool.close()                      # end of the sweep
+
+def render_tsne(weights_path, image_path):
+    # runs in a worker, sklearn / matplotlib are only imported here
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from sklearn.manifold import TSNE
+
+    W = np.load(weights_path)
+    x = TSNE(n_components=2).fit_transform(W.T)
+    fig = plt.figure()
+    for i, xt in enumerate(x):
+        plt.scatter(xt[0], xt[1], label=str(i))
+    plt.legend()
+
+    # write + rename so a half-written image is never picked up
+    tmp_path = image_path + '.tmp.png'
+    fig.savefig(tmp_path)
+    plt.close(fig)
+    os.replace(tmp_path, image_path)
+    return image_path
+
+def weights_digest(W):
+    h = hashlib.sha1(W.tobytes())
+    h.update('{}{}'.format(W.shape, W.dtype).encode())
+    return h.hexdigest()
+
+class ArtifactSpool:
+    def __init__(self, spool_dir='artifacts', project=None, n_workers=2, image_name='TSNE_weights'):
+        self.project = project
+        self.spool_dir = pathlib.Path(spool_dir)
+        self.spool_dir.mkdir(exist_ok=True, parents=True)
+        self.image_name = image_name
+        # spawn: workers must not inherit the training process' tf state
+        self.pool = concurrent.futures.ProcessPoolExecutor(n_workers, mp_context=mp.get_context('spawn'))
+        self.jobs = {} # digest -> future
+        self.pending = [] # (experiment id, digest) waiting for their image
+
+    def submit(self, W, experiment_id=None):
+        W = np.ascontiguousarray(W)
+        digest = weights_digest(W)
+        if digest not in self.jobs:
+            weights_path = self.spool_dir/'{}.npy'.format(digest)
+            image_path = self.spool_dir/'{}.png'.format(digest)
+            if image_path.exists():
+                # rendered by an earlier sweep
+                self.jobs[digest] = concurrent.futures.Future()
+                self.jobs[digest].set_result(str(image_path))
+            else:
+                np.save(str(weights_path), W)
+                self.jobs[digest] = self.pool.submit(render_tsne, str(weights_path), str(image_path))
+        if experiment_id is not None:
+            self.pending.append((experiment_id, digest))
+        return digest
+
+    def attach_ready(self, wait=False):
+        still_pending = []
+        for experiment_id, digest in self.pending:
+            job = self.jobs[digest]
+            if not (wait or job.done()):
+                still_pending.append((experiment_id, digest))
+                continue
+            try:
+                experiment = self.project.get_experiments(id=experiment_id)[0]
+                experiment.log_image(self.image_name, job.result())
+            except Exception as e:
+                print('Warning: artifact {} for {} failed: {!r}'.format(digest, experiment_id, e))
+        self.pending = still_pending
+
+    def close(self):
+        self.attach_ready(wait=True)
+        self.pool.shutdown()
@@ -0,0 +1,219 @@
+import tensorflow.compat.v1 as tf
+import numpy as np
+import argparse
+import multiprocessing as mp
+import queue
+import resource
+import time
+
+import models
+from configs import cifar_config
+
+# training throughput benchmarks on random CIFAR-shaped data
+#   python benchmarks.py augmentation --trainer L2Reg
+
+def base_config(**kwargs):
+    config = cifar_config()
+    config['epochs'] = 1
+    config.update(kwargs)
+    return config
+
+def random_data(n, input_shape=(32, 32, 3), n_classes=10):
+    x = np.random.rand(n, *input_shape).astype(np.float32)
+    y = np.eye(n_classes, dtype=np.float32)[np.random.randint(0, n_classes, n)]
+    return x, y
+
+def cifar_data(n_train, n_val):
+    (x, y), _ = tf.keras.datasets.cifar10.load_data()
+    x = x.astype(np.float32) / 255.
+    y = np.eye(10, dtype=np.float32)[y[:, 0]]
+    return (x[:n_train], y[:n_train]), (x[-n_val:], y[-n_val:])
+
+def run_and_put(results, fn, args):
+    results.put(fn(*args))
+
+def in_subprocess(fn, *args):
+    # fresh process per measurement so peak rss is not shared between runs 
+    # (spawned: forking after tf started its threads is unsafe)
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    p = ctx.Process(target=run_and_put, args=(results, fn, args))
+    p.start()
+    try:
+        while True:
+            try:
+                return results.get(timeout=1.)
+            except queue.Empty:
+                if p.exitcode is None:
+                    continue
+            # exited: pick up a result that raced the exit, else it failed
+            try:
+                return results.get(timeout=1.)
+            except queue.Empty:
+                raise RuntimeError('benchmark subprocess exited with code {}'.format(p.exitcode))
+    finally:
+        p.join()
+
+def throughput(trainer_class, config, n_steps=50, n_warmup=5):
+    x, y = random_data((n_steps + n_warmup) * config['batch_size'])
+
+    tf.reset_default_graph()
+    trainer = trainer_class(config)
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), \
+            tf.local_variables_initializer()])
+        sess.run(trainer.iterator_init, \
+            feed_dict={trainer.x_data: x, trainer.y_data: y})
+
+        def step(i):
+            sess.run(trainer.train_op)
+            if trainer.accumulation_steps > 1 and (i + 1) % trainer.accumulation_steps == 0:
+                sess.run(trainer.apply_op)
+
+        for i in range(n_warmup):
+            step(i)
+        start = time.perf_counter()
+        for i in range(n_steps):
+            step(i)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'steps_per_sec': n_steps / elapsed,
+        'samples_per_sec': n_steps * config['batch_size'] / elapsed,
+    }
+
+def throughput_and_memory(trainer_class, config, n_steps=50):
+    # for in_subprocess: the process peak is this configuration's 
+    return dict(throughput(trainer_class, config, n_steps), 
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+
+def train_and_evaluate(trainer_class, config, train_data, val_data, n_epochs=1):
+    tf.reset_default_graph()
+    tf.set_random_seed(0)
+    trainer = trainer_class(config)
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), \
+            tf.local_variables_initializer()])
+
+        n_steps = 0
+        start = time.perf_counter()
+        for _ in range(n_epochs):
+            sess.run(trainer.iterator_init, \
+                feed_dict={trainer.x_data: train_data[0], trainer.y_data: train_data[1]})
+            try: 
+                while True:
+                    sess.run(trainer.train_op)
+                    n_steps += 1
+            except tf.errors.OutOfRangeError: pass 
+        elapsed = time.perf_counter() - start
+
+        sess.run(trainer.acc_initializer)
+        sess.run(trainer.iterator_init, feed_dict={
+            trainer.x_data: val_data[0], 
+            trainer.y_data: val_data[1], 
+            trainer.is_training: False})
+        try: 
+            while True:
+                sess.run(trainer.acc_op)
+        except tf.errors.OutOfRangeError: pass 
+        val_acc = sess.run(trainer.acc)
+
+    return {
+        'dtype': trainer.compute_dtype.name,
+        'samples_per_sec': n_steps * config['batch_size'] / elapsed,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        'val_acc': float(val_acc),
+    }
+
+def print_rows(rows):
+    keys = list(rows[0].keys())
+    print(' '.join('{:>16}'.format(k) for k in keys))
+    for row in rows:
+        print(' '.join('{:>16.4g}'.format(v) if isinstance(v, float) else '{:>16}'.format(str(v)) \
+            for v in row.values()))
+
+#%%
+def augmentation(trainer_class, args):
+    rows = []
+    for name, kwargs in [
+        ('none', {'augmentation': False}),
+        ('crop+flip', {'augmentation': True}),
+        ('crop+flip+cutout', {'augmentation': True, 'cutout_size': 16})]:
+        config = base_config(batch_size=args.batch_size, **kwargs)
+        rows.append(dict({'augmentation': name}, **throughput(trainer_class, config, args.steps)))
+    return rows
+
+def large_batch(trainer_class, args):
+    rows = []
+    for batch_size, accumulation_steps in [(32, 1), (256, 1), (1024, 1), (256, 4)]:
+        config = base_config(batch_size=batch_size, accumulation_steps=accumulation_steps, 
+            lr_scaling='linear', warmup_steps=100)
+        row = {'batch_size': batch_size, 'accumulation_steps': accumulation_steps}
+        rows.append(dict(row, **in_subprocess(throughput_and_memory, trainer_class, config, args.steps)))
+    return rows
+
+def mixed_precision(trainer_class, args):
+    train_data, val_data = cifar_data(args.n_train, args.n_val)
+    rows = []
+    for mixed in [False, True]:
+        config = base_config(batch_size=args.batch_size, mixed_precision=mixed)
+        rows.append(in_subprocess(train_and_evaluate, trainer_class, config, \
+            train_data, val_data, args.epochs))
+    return rows
+
+def reg_grads(trainer_class, args):
+    # autodiffed kernel_regularizer penalties vs the closed-form fused gradients
+    rows = []
+    for name, kwargs in [
+        ('autodiff', {}),
+        ('analytic', {'analytic_reg_grads': True}),
+        ('decoupled', {'decoupled_weight_decay': True})]:
+        config = base_config(batch_size=args.batch_size, **kwargs)
+        rows.append(dict({'reg_grads': name}, **throughput(trainer_class, config, args.steps)))
+    return rows
+
+def reg_grads_check(trainer_class, args, tol=1e-4):
+    # closed-form penalty gradients (and values) vs tf.gradients of the kernel_regularizer
+    # closures, on random conv + dense kernels (trainer_class is ignored)
+    config = base_config()
+    rows = []
+    with tf.Graph().as_default(), tf.Session() as sess:
+        kernels = [tf.constant(np.random.randn(*shape).astype(np.float32)) \
+            for shape in [(3, 3, 4, 8), (5, 5, 2, 3), (16, 6)]]
+        for trainer_class in [models.L1Reg, models.L2Reg, models.OrthogonalReg]:
+            # only the reg closures are needed, not the model graph
+            trainer = trainer_class.__new__(trainer_class)
+            trainer.reg_constant = config['reg_constant']
+            trainer.set_reg_method(config)
+
+            analytic, penalty = trainer.reg_grad_method(kernels, trainer.reg_constant)
+            autodiff = [tf.gradients(trainer.kernel_reg_method(W), W)[0] for W in kernels]
+            autodiff_penalty = tf.add_n([trainer.kernel_reg_method(W) for W in kernels])
+            analytic, autodiff, penalty, autodiff_penalty = \
+                sess.run([analytic, autodiff, penalty, autodiff_penalty])
+            err = max(float(np.abs(a - b).max()) for a, b in zip(analytic, autodiff))
+            penalty_err = float(abs(penalty - autodiff_penalty) / abs(autodiff_penalty))
+            rows.append({'trainer': trainer_class.__name__, 'max_abs_err': err, 
+                'penalty_rel_err': penalty_err, 'ok': err < tol and penalty_err < tol})
+    return rows
+
+BENCHMARKS = {
+    'augmentation': augmentation,
+    'large_batch': large_batch,
+    'mixed_precision': mixed_precision,
+    'reg_grads': reg_grads,
+    'reg_grads_check': reg_grads_check,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=list(BENCHMARKS.keys()))
+    parser.add_argument('--trainer', default='Baseline')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--n-train', type=int, default=10000)
+    parser.add_argument('--n-val', type=int, default=2000)
+    args = parser.parse_args()
+
+    print_rows(BENCHMARKS[args.benchmark](getattr(models, args.trainer), args))
@@ -0,0 +1,258 @@
+import argparse
+import datetime
+import itertools
+import json
+import pathlib
+import sys
+import time
+
+from configs import DATASETS
+
+# sweep cli, tensorflow / neptune are only imported once a run actually starts
+#   python cli.py plan specs/example.json
+#   python cli.py run specs/example.json
+#   python cli.py list
+#   python cli.py resume example
+#   python cli.py report example
+#
+# spec format:
+#   {"name": "example", "dataset": "cifar", "base": {"epochs": 200},
+#    "runs": [{"trainer": "L1Reg", "grid": {"reg_constant": [1e-3, 1e-4]}},
+#             {"trainer": "Dropout", "config": {"dropout_constant": 0.5}}]}
+
+#%%
+def validate_spec(spec):
+    errors = []
+    if spec.get('dataset') not in DATASETS:
+        return ['unknown dataset {!r} (one of {})'.format(spec.get('dataset'), list(DATASETS))]
+    dataset = DATASETS[spec['dataset']]
+    config_keys = set(dataset['config']().keys())
+
+    def check_keys(where, keys):
+        for k in keys:
+            if k not in config_keys:
+                errors.append('{}: unknown config key {!r}'.format(where, k))
+
+    check_keys('base', spec.get('base', {}))
+    if not spec.get('runs'):
+        errors.append('spec has no runs')
+    for i, run in enumerate(spec.get('runs', [])):
+        where = 'runs[{}]'.format(i)
+        if run.get('trainer') not in dataset['trainers']:
+            errors.append('{}: unknown trainer {!r} (one of {})'.format(where, run.get('trainer'), dataset['trainers']))
+        check_keys(where + '.config', run.get('config', {}))
+        check_keys(where + '.grid', run.get('grid', {}))
+        for k, values in run.get('grid', {}).items():
+            if not isinstance(values, list) or len(values) == 0:
+                errors.append('{}.grid: {!r} must be a non-empty list'.format(where, k))
+    return errors
+
+def load_spec(path):
+    with open(str(path)) as f:
+        spec = json.load(f)
+    errors = validate_spec(spec)
+    if errors:
+        print('Invalid sweep spec {}:'.format(path))
+        for error in errors:
+            print('  ' + error)
+        sys.exit(2)
+    spec.setdefault('name', pathlib.Path(path).stem)
+    return spec
+
+def expand(spec):
+    dataset = DATASETS[spec['dataset']]
+    runs = []
+    for run in spec['runs']:
+        grid = run.get('grid', {})
+        keys = sorted(grid)
+        for values in itertools.product(*[grid[k] for k in keys]):
+            params = dict(run.get('config', {}), **dict(zip(keys, values)))
+            config = dataset['config'](spec.get('trial_run', False))
+            config.update(spec.get('base', {}))
+            config.update(params)
+            runs.append({'id': str(len(runs)), 'trainer': run['trainer'], 'params': params, 'config': config})
+    return runs
+
+def estimate_seconds(spec, config):
+    dataset = DATASETS[spec['dataset']]
+    seconds_per_sample = spec.get('seconds_per_sample', dataset['seconds_per_sample'])
+    # upper bound (no early stopping), a validation sample ~ 1/3 of a training sample
+    samples = dataset['n_train'] + dataset['n_val'] / 3.
+    return config['epochs'] * samples * seconds_per_sample / config.get('num_workers', 1)
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+def print_plan(spec, runs, state={}):
+    print('{} ({}, {} runs)'.format(spec['name'], spec['dataset'], len(runs)))
+    print('{:>4} {:<14} {:<12} {:>12}  {}'.format('id', 'trainer', 'status', 'est. cost', 'params'))
+    total = 0.
+    for run in runs:
+        seconds = estimate_seconds(spec, run['config'])
+        status = state.get(run['id'], {}).get('status', 'pending')
+        if status != 'done':
+            total += seconds
+        print('{:>4} {:<14} {:<12} {:>12}  {}'.format(run['id'], run['trainer'], status, \
+            format_duration(seconds), json.dumps(run['params'])))
+    print('estimated remaining cost: {} (upper bound, before early stopping)'.format(format_duration(total)))
+
+#%%
+# sweep state: <sweep_dir>/<name>/spec.json + runs.json
+def load_state(path):
+    state_path = path/'runs.json'
+    return json.loads(state_path.read_text()) if state_path.exists() else {}
+
+def save_state(path, state):
+    tmp = path/'runs.json.tmp'
+    tmp.write_text(json.dumps(state, indent=2))
+    tmp.replace(path/'runs.json')
+
+def execute(path, spec, only=None):
+    state = load_state(path)
+    runs = [r for r in expand(spec) if state.get(r['id'], {}).get('status') != 'done']
+    if only:
+        runs = [r for r in runs if r['id'] in only]
+    print_plan(spec, runs, state)
+    if not runs:
+        print('Nothing to run')
+        return
+    if spec['dataset'] != 'cifar':
+        sys.exit('Only cifar sweeps can be run from the cli (MNIST_experiment/main.py has no train loop)')
+
+    # heavy imports only on the path that trains
+    import main
+    import models
+    from writers import NeptuneWriter
+
+    data = main.get_train_test()
+    writer = NeptuneWriter(spec.get('project', DATASETS[spec['dataset']]['project']))
+    trial_run = spec.get('trial_run', False)
+
+    for run in runs:
+        record = {'status': 'running', 'trainer': run['trainer'], 'params': run['params'],
+            'started': datetime.datetime.now().isoformat()}
+        state[run['id']] = record
+        save_state(path, state)
+
+        start = time.time()
+        try:
+            result = main.run_experiment(getattr(models, run['trainer']), run['config'], \
+                data, writer, trial_run)
+        except KeyboardInterrupt:
+            record['status'] = 'interrupted'
+            save_state(path, state)
+            raise
+        except Exception as e:
+            record.update(status='failed', error=repr(e))
+            save_state(path, state)
+            print('Run {} failed: {!r}'.format(run['id'], e))
+            writer.fin()
+            continue
+
+        record.update(result, status='done', seconds=time.time() - start,
+            finished=datetime.datetime.now().isoformat())
+        save_state(path, state)
+
+#%%
+def cmd_plan(args):
+    spec = load_spec(args.spec)
+    path = pathlib.Path(args.sweep_dir)/spec['name']
+    print_plan(spec, expand(spec), load_state(path) if path.exists() else {})
+
+def cmd_run(args):
+    spec = load_spec(args.spec)
+    path = pathlib.Path(args.sweep_dir)/spec['name']
+    spec_path = path/'spec.json'
+    if spec_path.exists() and json.loads(spec_path.read_text()) != spec:
+        sys.exit('Sweep {} already exists with a different spec - use a new name or `resume`'.format(spec['name']))
+    path.mkdir(exist_ok=True, parents=True)
+    spec_path.write_text(json.dumps(spec, indent=2))
+    execute(path, spec, args.only)
+
+def cmd_resume(args):
+    path = pathlib.Path(args.sweep_dir)/args.name
+    if not (path/'spec.json').exists():
+        sys.exit('No sweep named {} in {}'.format(args.name, args.sweep_dir))
+    execute(path, json.loads((path/'spec.json').read_text()), args.only)
+
+def cmd_list(args):
+    sweep_dir = pathlib.Path(args.sweep_dir)
+    paths = sorted(p for p in sweep_dir.iterdir() if (p/'spec.json').exists()) if sweep_dir.exists() else []
+    if not paths:
+        print('No sweeps in {}'.format(sweep_dir))
+    for path in paths:
+        spec = json.loads((path/'spec.json').read_text())
+        state = load_state(path)
+        n_runs = len(expand(spec))
+        counts = {}
+        for record in state.values():
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+        print('{:<24} {:<6} {:>3}/{:<3} done  {}'.format(path.name, spec['dataset'], \
+            counts.get('done', 0), n_runs,
+            ' '.join('{}={}'.format(k, v) for k, v in sorted(counts.items()) if k != 'done')))
+
+def cmd_report(args):
+    # cost vs accuracy of the finished runs (telemetry totals recorded by main.train)
+    path = pathlib.Path(args.sweep_dir)/args.name
+    state = load_state(path)
+    rows = sorted(((k, r) for k, r in state.items() if r['status'] == 'done'), \
+        key=lambda kr: -kr[1]['test_acc'])
+    if not rows:
+        print('No finished runs in {}'.format(args.name))
+        return
+
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else '-'
+
+    print('{:>4} {:<14} {:>8} {:>10} {:>10} {:>8} {:>9}  {}'.format(
+        'id', 'trainer', 'test_acc', 'time', 'steps/s', 'cpu', 'max MB', 'params'))
+    for run_id, r in rows:
+        print('{:>4} {:<14} {:>8} {:>10} {:>10} {:>8} {:>9}  {}'.format(
+            run_id, r['trainer'], fmt(r['test_acc'], '.4f'), format_duration(r['seconds']),
+            fmt(r.get('mean_steps_per_sec'), '.2f'), fmt(r.get('mean_cpu_util'), '.2f'),
+            fmt(r.get('max_rss_mb'), '.0f'), json.dumps(r['params'])))
+
+def cmd_calibrate(args):
+    import benchmarks
+    import models
+    config = benchmarks.base_config(batch_size=args.batch_size)
+    samples_per_sec = benchmarks.throughput(getattr(models, args.trainer), config, args.steps)['samples_per_sec']
+    print('seconds_per_sample: {:.3g}'.format(1. / samples_per_sec))
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Plan, run and resume regularization sweeps')
+    parser.add_argument('--sweep-dir', default='sweeps')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    plan = commands.add_parser('plan', help='validate a spec and print the run grid + estimated cost')
+    plan.add_argument('spec')
+    plan.set_defaults(fn=cmd_plan)
+
+    run = commands.add_parser('run', help='run every pending run of a spec')
+    run.add_argument('spec')
+    run.add_argument('--only', nargs='+', help='run ids to run')
+    run.set_defaults(fn=cmd_run)
+
+    resume = commands.add_parser('resume', help='re-run the unfinished runs of a sweep')
+    resume.add_argument('name')
+    resume.add_argument('--only', nargs='+', help='run ids to run')
+    resume.set_defaults(fn=cmd_resume)
+
+    list_ = commands.add_parser('list', help='list sweeps and their progress')
+    list_.set_defaults(fn=cmd_list)
+
+    report = commands.add_parser('report', help='cost vs accuracy table of finished runs')
+    report.add_argument('name')
+    report.set_defaults(fn=cmd_report)
+
+    calibrate = commands.add_parser('calibrate', help='measure seconds_per_sample for cost estimates (cifar)')
+    calibrate.add_argument('--trainer', default='Baseline')
+    calibrate.add_argument('--batch-size', type=int, default=32)
+    calibrate.add_argument('--steps', type=int, default=50)
+    calibrate.set_defaults(fn=cmd_calibrate)
+    return parser
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    args.fn(args)
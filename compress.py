@@ -0,0 +1,210 @@
+import tensorflow.compat.v1 as tf
+import numpy as np
+import json
+import time
+import pathlib
+
+from layer_ops import build_inference_graph
+
+#%%
+# post-training compression of trained trainers
+# usage (inside the training session):
+#   specs = get_layer_weights(sess, trainer.get_inference_layers())
+#   rows = sparse_report(specs, x_test, y_test, [1e-4, 1e-3, 1e-2])
+
+def evaluate(build_fn, x, y, batch_size=256):
+    with tf.Graph().as_default():
+        x_in = tf.placeholder(tf.float32, [None] + list(x.shape[1:]))
+        probs = build_fn(x_in)
+        with tf.Session() as sess:
+            sess.run(probs, feed_dict={x_in: x[:batch_size]}) # warmup
+
+            correct = 0
+            start = time.perf_counter()
+            for i in range(0, len(x), batch_size):
+                p = sess.run(probs, feed_dict={x_in: x[i:i+batch_size]})
+                correct += np.sum(np.argmax(p, 1) == np.argmax(y[i:i+batch_size], 1))
+            elapsed = time.perf_counter() - start
+
+    # accuracy, ms per sample
+    return correct / len(x), 1000. * elapsed / len(x)
+
+def specs_nbytes(specs):
+    nbytes = 0
+    for spec in specs:
+        for p in spec['params']:
+            if isinstance(p, dict):
+                nbytes += sum(v.nbytes for v in p.values())
+            else:
+                nbytes += p.nbytes
+    return nbytes
+
+def print_report(rows, key):
+    print('{:>10} {:>8} {:>10} {:>10} {:>8}'.format(key, 'acc', 'ms/sample', 'MB', 'ratio'))
+    for row in rows:
+        print('{:>10} {:>8.4f} {:>10.4f} {:>10.3f} {:>8.3f}'.format(
+            str(row[key]), row['acc'], row['ms_per_sample'], row['nbytes'] / 2**20, row['size_ratio']))
+
+#%%
+# sparse (L1)
+def prune(W, threshold):
+    return np.where(np.abs(W) < threshold, 0., W).astype(W.dtype)
+
+def to_csr(W):
+    rows, cols = np.nonzero(W)
+    indptr = np.concatenate([[0], np.cumsum(np.count_nonzero(W, axis=1))])
+    return {
+        'data': W[rows, cols],
+        'indices': cols.astype(np.int32),
+        'indptr': indptr.astype(np.int32),
+        'shape': np.array(W.shape, dtype=np.int64),
+    }
+
+def csr_to_sparse_tensor(csr):
+    rows = np.repeat(np.arange(csr['shape'][0]), np.diff(csr['indptr']))
+    indices = np.stack([rows, csr['indices']], 1).astype(np.int64)
+    return tf.SparseTensor(indices, tf.constant(csr['data']), csr['shape'])
+
+def sparse_matmul(x, kernel):
+    # kernel holds W^T (out x in) so each csr row is one output unit
+    return tf.transpose(tf.sparse.sparse_dense_matmul(kernel, x, adjoint_b=True))
+
+def sparsify(specs, threshold):
+    # only dense layers are stored in csr, conv kernels stay dense
+    sparse_specs = []
+    for spec in specs:
+        spec = dict(spec)
+        if spec['kind'] == 'Dense':
+            kernel, bias = spec['params']
+            spec['params'] = [to_csr(prune(kernel, threshold).T), bias]
+        sparse_specs.append(spec)
+    return sparse_specs
+
+def build_sparse_graph(x, sparse_specs):
+    specs = []
+    for spec in sparse_specs:
+        spec = dict(spec)
+        if spec['kind'] == 'Dense':
+            spec['params'] = [csr_to_sparse_tensor(spec['params'][0]), spec['params'][1]]
+        specs.append(spec)
+    return build_inference_graph(x, specs, matmul=sparse_matmul)
+
+def save_sparse(path, sparse_specs):
+    arrays, meta = {}, []
+    for i, spec in enumerate(sparse_specs):
+        meta.append({'kind': spec['kind'], 'config': spec['config'], 'n_params': len(spec['params'])})
+        for j, p in enumerate(spec['params']):
+            if isinstance(p, dict):
+                for k, v in p.items():
+                    arrays['{}_{}_csr_{}'.format(i, j, k)] = v
+            else:
+                arrays['{}_{}'.format(i, j)] = p
+    arrays['meta'] = np.array(json.dumps(meta))
+    np.savez(str(path), **arrays)
+
+def load_sparse(path):
+    arrays = np.load(str(path))
+    specs = []
+    for i, m in enumerate(json.loads(str(arrays['meta']))):
+        params = []
+        for j in range(m['n_params']):
+            key = '{}_{}'.format(i, j)
+            if key in arrays:
+                params.append(arrays[key])
+            else:
+                params.append({k: arrays['{}_csr_{}'.format(key, k)] \
+                    for k in ['data', 'indices', 'indptr', 'shape']})
+        specs.append({'kind': m['kind'], 'config': m['config'], 'params': params})
+    return specs
+
+def sparse_report(specs, x, y, thresholds, export_dir=None):
+    dense_nbytes = specs_nbytes(specs)
+    acc, ms = evaluate(lambda x_in: build_inference_graph(x_in, specs), x, y)
+    rows = [{'threshold': 'dense', 'acc': acc, 'ms_per_sample': ms,
+        'nbytes': dense_nbytes, 'size_ratio': 1., 'sparsity': 0.}]
+
+    for threshold in thresholds:
+        sparse_specs = sparsify(specs, threshold)
+        if export_dir is not None:
+            export_dir = pathlib.Path(export_dir)
+            export_dir.mkdir(exist_ok=True, parents=True)
+            save_sparse(export_dir/'sparse_{}.npz'.format(threshold), sparse_specs)
+
+        dense_kernels = [s['params'][0] for s in specs if s['kind'] == 'Dense']
+        n_zero = sum(np.sum(np.abs(W) < threshold) for W in dense_kernels)
+        n_total = sum(W.size for W in dense_kernels)
+
+        acc, ms = evaluate(lambda x_in: build_sparse_graph(x_in, sparse_specs), x, y)
+        nbytes = specs_nbytes(sparse_specs)
+        rows.append({'threshold': threshold, 'acc': acc, 'ms_per_sample': ms,
+            'nbytes': nbytes, 'size_ratio': nbytes / dense_nbytes,
+            'sparsity': n_zero / n_total})
+
+    print_report(rows, 'threshold')
+    return rows
+
+#%%
+# low-rank (spectral / orthogonal)
+def truncated_svd(W, energy):
+    U, s, Vt = np.linalg.svd(W, full_matrices=False)
+    # smallest rank keeping `energy` of the squared singular values 
+    cum_energy = np.cumsum(s ** 2) / np.sum(s ** 2)
+    rank = min(int(np.searchsorted(cum_energy, energy)) + 1, len(s))
+    A = U[:, :rank] * s[:rank]
+    B = Vt[:rank]
+    return A.astype(W.dtype), B.astype(W.dtype)
+
+def factorize(specs, energy, include_conv=True):
+    lowrank_specs, ranks = [], []
+    for spec in specs:
+        if spec['kind'] not in ['Dense', 'Conv2D'] or \
+            (spec['kind'] == 'Conv2D' and not include_conv):
+            lowrank_specs.append(spec)
+            continue
+
+        kernel, bias = spec['params']
+        W = kernel.reshape(-1, kernel.shape[-1]) # flatten using same means as spectral 
+        A, B = truncated_svd(W, energy)
+        rank = A.shape[1]
+
+        # only swap in the thin matmuls when they are cheaper than the dense one 
+        if rank * (W.shape[0] + W.shape[1]) >= W.size:
+            lowrank_specs.append(spec)
+            ranks.append(None)
+            continue
+        ranks.append(rank)
+
+        if spec['kind'] == 'Dense':
+            lowrank_specs += [
+                {'kind': 'Dense', 'config': {'activation': 'linear'}, 'params': [A]},
+                {'kind': 'Dense', 'config': spec['config'], 'params': [B, bias]},
+            ]
+        else:
+            # k x k conv into `rank` filters followed by a 1x1 conv
+            lowrank_specs += [
+                {'kind': 'Conv2D', 
+                'config': dict(spec['config'], activation='linear'), 
+                'params': [A.reshape(kernel.shape[:-1] + (rank,))]},
+                {'kind': 'Conv2D', 
+                'config': dict(spec['config'], strides=[1, 1], padding='same'), 
+                'params': [B.reshape((1, 1, rank, -1)), bias]},
+            ]
+    return lowrank_specs, ranks
+
+def lowrank_report(specs, x, y, energies, include_conv=True):
+    dense_nbytes = specs_nbytes(specs)
+    acc, ms = evaluate(lambda x_in: build_inference_graph(x_in, specs), x, y)
+    rows = [{'energy': 'dense', 'acc': acc, 'ms_per_sample': ms,
+        'nbytes': dense_nbytes, 'size_ratio': 1., 'ranks': []}]
+
+    for energy in energies:
+        lowrank_specs, ranks = factorize(specs, energy, include_conv)
+        acc, ms = evaluate(lambda x_in: build_inference_graph(x_in, lowrank_specs), x, y)
+        nbytes = specs_nbytes(lowrank_specs)
+        rows.append({'energy': energy, 'acc': acc, 'ms_per_sample': ms,
+            'nbytes': nbytes, 'size_ratio': nbytes / dense_nbytes, 'ranks': ranks})
+
+    print_report(rows, 'energy')
+    for row in rows[1:]:
+        print('energy {} ranks: {}'.format(row['energy'], row['ranks']))
+    return rows
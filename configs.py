@@ -0,0 +1,64 @@
+# experiment defaults + the trainer names sweep specs are validated against.
+# no tensorflow imports here so planning / listing sweeps stays instant
+
+CIFAR_TRAINERS = ['Baseline', 'Dropout', 'SpectralReg', 'OrthogonalReg', 'L2Reg', 'L1Reg']
+MNIST_TRAINERS = ['Baseline', 'DropoutReg', 'SpectralReg', 'OrthogonalReg', 'L2Reg', 'L1Reg', 'LipschitzReg']
+
+def cifar_config(trial_run=False):
+    return {
+        'batch_size': 32 if not trial_run else 2,
+        'learning_rate': 1e-4,
+        # large-batch mode: effective batch = batch_size * accumulation_steps
+        'accumulation_steps': 1,
+        'base_batch_size': 32, # batch size learning_rate was tuned at
+        'lr_scaling': None, # None, 'linear' or 'sqrt'
+        'warmup_steps': 0,
+        'mixed_precision': False, # bf16 activations/matmuls, float32 weights + penalties
+        'num_workers': 1, # > 1: data-parallel over local processes (batch_size is global)
+        'overlap_validation': False, # validate epoch snapshots in the background, early stop one epoch late
+        'telemetry': True, # per-epoch wall time, steps/sec, rss, cpu and tf allocator channels
+        'epochs': 200 if not trial_run else 1,
+        'reg_constant': 0.001,
+        'dropout_constant': 0.3,
+        'analytic_reg_grads': False, # L1/L2/orthogonal: closed-form penalty gradients instead of autodiff
+        'decoupled_weight_decay': False, # ... applied as a separate W -= lr * grad step (implies analytic_reg_grads)
+        'dense_regularization': True,
+        'kernel_regularization': True,
+        'augmentation': False,
+        'crop_padding': 4,
+        'flip': True,
+        'cutout_size': 0, # e.g. 16
+        'sparse_thresholds': [], # e.g. [1e-4, 1e-3, 1e-2] for L1 runs
+        'export_dir': None,
+        'lowrank_energies': [], # e.g. [0.9, 0.95, 0.99] for spectral/orthogonal runs
+        'serve_export_dir': None, # e.g. 'exports/'
+    }
+
+def mnist_config(trial_run=False):
+    return {
+        'batch_size': 32,
+        'epochs': 200 if not trial_run else 1,
+        'reg_constant': 0.01,
+        'dropout_constant': 0.3,
+    }
+
+DATASETS = {
+    'cifar': {
+        'trainers': CIFAR_TRAINERS,
+        'config': cifar_config,
+        'project': 'gebob19/672-cifar',
+        'n_train': 40000,
+        'n_val': 10000,
+        # rough cpu training cost, override with spec['seconds_per_sample']
+        # or measure it with `python cli.py calibrate`
+        'seconds_per_sample': 2e-3,
+    },
+    'mnist': {
+        'trainers': MNIST_TRAINERS,
+        'config': mnist_config,
+        'project': 'gebob19/672-mnist',
+        'n_train': 50000,
+        'n_val': 10000,
+        'seconds_per_sample': 5e-6,
+    },
+}
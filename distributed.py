@@ -0,0 +1,244 @@
+import tensorflow.compat.v1 as tf
+import numpy as np
+import multiprocessing as mp
+import os
+import queue
+import time
+
+from telemetry import ResourceSampler, summarize
+
+# local multi-process data-parallel training for a single run
+# each worker holds a replica and trains on a 1/n_workers shard of every batch.
+# the per-worker gradients (trainer.grads, i.e. after SpectralReg's edits and with
+# the layer.losses regularizers already in the loss or analytic_reg_grads added) are
+# averaged through shared memory (a reduce-scatter over localhost) and every replica
+# applies the same update. workers are spawned (not forked), the data is shared memory.
+#   train_data_parallel(L2Reg, config, data, n_workers=4, writer=writer) -> {'test_acc', **telemetry totals}
+
+# per-worker status columns (+ per-worker telemetry)
+HAS_BATCH, TRAIN_LOSS, TRAIN_ACC, VAL_LOSS, VAL_ACC, TEST_ACC, \
+    WALL_TIME, STEPS_PER_SEC, CPU_UTIL, RSS_MB, MAX_RSS_MB, PROCESS_PEAK_RSS_MB = range(12)
+N_STATUS = 12
+
+def shard(x, rank, n_workers):
+    # equal shard sizes so every worker runs the same number of steps
+    n = len(x) // n_workers * n_workers
+    return x[:n][rank::n_workers]
+
+def flatten(arrays):
+    return np.concatenate([np.reshape(a, [-1]) for a in arrays])
+
+def unflatten(flat, shapes):
+    arrays, i = [], 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(np.reshape(flat[i:i+size], shape))
+        i += size
+    return arrays
+
+def to_shared(ctx, a):
+    a = np.ascontiguousarray(a, dtype=np.float32)
+    buf = ctx.RawArray('f', a.size)
+    np.frombuffer(buf, dtype=np.float32)[:] = a.reshape(-1)
+    return buf, a.shape
+
+def from_shared(buf, shape):
+    return np.frombuffer(buf, dtype=np.float32).reshape(shape)
+
+def evaluate(sess, trainer, x, y, trial_run=False):
+    losses = []
+    sess.run(trainer.acc_initializer)
+    sess.run(trainer.iterator_init, feed_dict={
+        trainer.x_data: x,
+        trainer.y_data: y,
+        trainer.is_training: False})
+    try:
+        while True:
+            loss, _ = sess.run([trainer.loss, trainer.acc_op])
+            losses.append(loss)
+            if trial_run: break
+    except tf.errors.OutOfRangeError: pass
+    return np.mean(losses), sess.run(trainer.acc)
+
+def worker(rank, n_workers, trainer_class, config, data, buffers, barrier, results, trial_run):
+    (x_train, y_train), (x_val, y_val), (x_test, y_test) = \
+        [[shard(from_shared(*a), rank, n_workers) for a in split] for split in data]
+
+    worker_config = config.copy()
+    worker_config['batch_size'] = config['batch_size'] // n_workers
+    # lr scaling is relative to the global batch the averaged update covers
+    worker_config['global_batch_size'] = config['batch_size']
+
+    with tf.Graph().as_default():
+        trainer = trainer_class(worker_config)
+        variables = trainer.train_variables
+        shapes = [v.shape.as_list() for v in variables]
+        grad_phs = [tf.placeholder(v.dtype.base_dtype, v.shape) for v in variables]
+        apply_op = trainer.optimizer.apply_gradients(zip(grad_phs, variables), \
+            global_step=trainer.global_step)
+
+        grads_buf = np.frombuffer(buffers['grads'], dtype=np.float32).reshape(n_workers, -1)
+        mean_buf = np.frombuffer(buffers['mean_grads'], dtype=np.float32)
+        # this rank reduces params [lo, hi) 
+        bounds = np.linspace(0, len(mean_buf), n_workers + 1).astype(int)
+        lo, hi = bounds[rank], bounds[rank + 1]
+        status = np.frombuffer(buffers['status'], dtype=np.float64).reshape(n_workers, N_STATUS)
+
+        threads = max(1, os.cpu_count() // n_workers)
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=threads, \
+            inter_op_parallelism_threads=threads)
+
+        with tf.Session(config=session_config) as sess:
+            sess.run([tf.global_variables_initializer(), \
+                tf.local_variables_initializer()])
+
+            # broadcast rank 0's initial weights
+            if rank == 0:
+                grads_buf[0] = flatten(sess.run(variables))
+            barrier.wait()
+            if rank != 0:
+                for v, w in zip(variables, unflatten(grads_buf[0], shapes)):
+                    v.load(w, sess)
+            barrier.wait()
+
+            if config['telemetry']:
+                sampler = ResourceSampler().start()
+
+            # for early stopping (decided by rank 0)
+            require_improvement = 10
+            last_improvement = 0
+            best_score = 0.
+
+            for e in range(config['epochs']):
+                losses = []
+                if config['telemetry']:
+                    sampler.begin()
+                train_start = time.perf_counter()
+                sess.run(trainer.acc_initializer) # reset accuracy metric
+                sess.run(trainer.iterator_init, \
+                    feed_dict={trainer.x_data: x_train, trainer.y_data: y_train})
+                while True:
+                    try:
+                        grads, loss, _ = sess.run([trainer.grads, trainer.loss, trainer.acc_op])
+                        grads_buf[rank] = flatten(grads)
+                        status[rank, HAS_BATCH] = 1
+                        losses.append(loss)
+                    except tf.errors.OutOfRangeError:
+                        status[rank, HAS_BATCH] = 0
+                    barrier.wait()
+
+                    # epoch ends as soon as one shard is exhausted
+                    if status[:, HAS_BATCH].min() == 0:
+                        barrier.wait()
+                        break
+
+                    # reduce-scatter: each rank averages its 1/n_workers slice, then 
+                    # every rank reads the reduced gradients. grads_buf / mean_buf are 
+                    # only written again after the next step's first barrier, i.e. once 
+                    # every rank has finished applying this update 
+                    mean_buf[lo:hi] = grads_buf[:, lo:hi].mean(0)
+                    barrier.wait()
+                    mean_grads = unflatten(mean_buf, shapes)
+                    sess.run(apply_op, feed_dict=dict(zip(grad_phs, mean_grads)))
+                    if trial_run: break
+
+                status[rank, TRAIN_LOSS] = np.mean(losses)
+                status[rank, TRAIN_ACC] = sess.run(trainer.acc)
+                status[rank, STEPS_PER_SEC] = len(losses) / (time.perf_counter() - train_start)
+                status[rank, VAL_LOSS], status[rank, VAL_ACC] = \
+                    evaluate(sess, trainer, x_val, y_val, trial_run)
+                if config['telemetry']:
+                    t = sampler.end()
+                    status[rank, [WALL_TIME, CPU_UTIL, RSS_MB, MAX_RSS_MB, PROCESS_PEAK_RSS_MB]] = \
+                        [t['wall_time'], t['cpu_util'], t['rss_mb'], t['max_rss_mb'], t['process_peak_rss_mb']]
+                barrier.wait()
+
+                if rank == 0:
+                    mean_status = status.mean(0)
+                    epoch_metrics = {
+                        'train_loss': mean_status[TRAIN_LOSS],
+                        'val_loss': mean_status[VAL_LOSS],
+                        'train_acc': mean_status[TRAIN_ACC],
+                        'val_acc': mean_status[VAL_ACC],
+                    }
+                    if config['telemetry']:
+                        # the whole job: time / steps of rank 0, resources summed over workers
+                        epoch_metrics.update({
+                            'wall_time': status[0, WALL_TIME],
+                            'steps_per_sec': status[0, STEPS_PER_SEC],
+                            'cpu_util': status[:, CPU_UTIL].sum(),
+                            'rss_mb': status[:, RSS_MB].sum(),
+                            'max_rss_mb': status[:, MAX_RSS_MB].sum(),
+                            'process_peak_rss_mb': status[:, PROCESS_PEAK_RSS_MB].sum(),
+                        })
+                    if epoch_metrics['val_acc'] > best_score:
+                        best_score = epoch_metrics['val_acc']
+                        last_improvement = 0
+                    else:
+                        last_improvement += 1
+                    buffers['stop'].value = int(last_improvement > require_improvement)
+                    results.put(('epoch', e, epoch_metrics))
+                barrier.wait()
+
+                if buffers['stop'].value:
+                    break
+
+            if config['telemetry']:
+                sampler.stop()
+            status[rank, TEST_ACC] = evaluate(sess, trainer, x_test, y_test, trial_run)[1]
+            barrier.wait()
+            if rank == 0:
+                results.put(('test', e+1, {'test_acc': status[:, TEST_ACC].mean()}))
+
+def train_data_parallel(trainer_class, config, data, n_workers, writer, trial_run=False):
+    assert config['batch_size'] % n_workers == 0, 'batch_size must be divisible by n_workers'
+    assert config['accumulation_steps'] == 1, 'gradient accumulation is not supported with n_workers > 1'
+    assert not config['decoupled_weight_decay'], 'decoupled_weight_decay is not supported with n_workers > 1'
+    for key in ['overlap_validation', 'sparse_thresholds', 'lowrank_energies', 'serve_export_dir']:
+        assert not config[key], '{} is not supported with n_workers > 1'.format(key)
+
+    # spawn: this process may already run tf threads (earlier runs, the bf16 probe)
+    # which a forked child would inherit in an arbitrary state
+    ctx = mp.get_context('spawn')
+    with tf.Graph().as_default():
+        # only shapes are needed (skips the bf16 probe session)
+        count_config = dict(config, mixed_precision=False)
+        n_params = sum(int(np.prod(v.shape.as_list())) for v in trainer_class(count_config).train_variables)
+    data = [[to_shared(ctx, a) for a in split] for split in data]
+    buffers = {
+        'grads': ctx.RawArray('f', n_workers * n_params),
+        'mean_grads': ctx.RawArray('f', n_params),
+        'status': ctx.RawArray('d', n_workers * N_STATUS),
+        'stop': ctx.RawValue('i', 0),
+    }
+    barrier = ctx.Barrier(n_workers)
+    results = ctx.Queue()
+
+    processes = [ctx.Process(target=worker, args=(rank, n_workers, trainer_class, config, \
+        data, buffers, barrier, results, trial_run)) for rank in range(n_workers)]
+    for p in processes: p.start()
+
+    kind = None
+    run_telemetry = []
+    try:
+        while True:
+            try:
+                kind, step, metrics = results.get(timeout=1.)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError('data-parallel worker died')
+                continue
+
+            writer.write(metrics, step)
+            if kind == 'test':
+                test_acc = metrics['test_acc']
+                break
+            if config['telemetry']:
+                run_telemetry.append(metrics)
+            print('{}: {:.2f} acc: {:.2f} {:.2f}'.format(step, metrics['train_loss'], \
+                metrics['train_acc'], metrics['val_acc']))
+    finally:
+        for p in processes:
+            if p.exitcode is None and kind != 'test': p.terminate()
+        for p in processes: p.join()
+    return dict({'test_acc': float(test_acc)}, **summarize(run_telemetry))
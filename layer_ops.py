@@ -0,0 +1,59 @@
+import tensorflow.compat.v1 as tf
+import numpy as np
+
+# rebuilds the keras layer stack of a trainer out of plain tf ops so the
+# trained weights can be evaluated outside of the training graph
+# (no dataset iterator, no is_training placeholder)
+
+def layer_config(layer):
+    kind = type(layer).__name__
+    config = {}
+    if kind in ['Conv2D', 'MaxPooling2D']:
+        config['strides'] = list(layer.strides)
+        config['padding'] = layer.padding
+    if kind == 'MaxPooling2D':
+        config['pool_size'] = list(layer.pool_size)
+    if kind in ['Conv2D', 'Dense']:
+        config['activation'] = tf.keras.activations.serialize(layer.activation)
+    return config
+
+def get_layer_weights(sess, layers):
+    specs = []
+    for layer in layers:
+        kind = type(layer).__name__
+        # dropout is the identity at inference
+        if kind == 'Dropout':
+            continue
+        specs.append({
+            'kind': kind,
+            'config': layer_config(layer),
+            'params': sess.run(layer.weights),
+        })
+    return specs
+
+def apply_layer(x, kind, config, params, matmul=tf.matmul):
+    if kind == 'Conv2D':
+        x = tf.nn.conv2d(x, params[0], strides=[1] + config['strides'] + [1],
+            padding=config['padding'].upper())
+    elif kind == 'MaxPooling2D':
+        x = tf.nn.max_pool(x, ksize=[1] + config['pool_size'] + [1],
+            strides=[1] + config['strides'] + [1], padding=config['padding'].upper())
+    elif kind == 'Flatten':
+        x = tf.reshape(x, [-1, int(np.prod(x.shape.as_list()[1:]))])
+    elif kind == 'Dense':
+        x = matmul(x, params[0])
+    else:
+        raise ValueError('Unsupported layer type: {}'.format(kind))
+
+    # bias + activation
+    if kind in ['Conv2D', 'Dense']:
+        if len(params) > 1 and params[1] is not None:
+            x = tf.nn.bias_add(x, params[1])
+        x = tf.keras.activations.get(config['activation'])(x)
+    return x
+
+def build_inference_graph(x, specs, matmul=tf.matmul):
+    for spec in specs:
+        params = [tf.constant(p) if isinstance(p, np.ndarray) else p for p in spec['params']]
+        x = apply_layer(x, spec['kind'], spec['config'], params, matmul)
+    return x
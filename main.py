@@ -1,8 +1,18 @@
 #%%
 import tensorflow.compat.v1 as tf 
 import numpy as np 
+import contextlib
+import os
+import time 
 from writers import NeptuneWriter
 from models import *
+from layer_ops import get_layer_weights
+from compress import sparse_report, lowrank_report
+from serve import export_frozen
+from distributed import train_data_parallel
+from configs import cifar_config
+from snapshot_eval import SnapshotEvaluator
+from telemetry import ResourceSampler, allocator_bytes_op, summarize
 
 
 #%%
@@ -46,36 +56,118 @@ def mean_over_dict(custom_metrics):
     return mean_metrics
 
 #%%
-def train(trainer):
+def train(trainer, config, data, writer, trial_run=False):
+    (x_train, y_train), (x_val, y_val), (x_test, y_test) = data
+
     # for early stopping 
     require_improvement = 10
     last_improvement = 0 
     stop = False 
 
-    with tf.Session() as sess: 
+    # overlapped validation: evaluate a weight snapshot in a background session 
+    # while the next epoch trains, early stopping acts on it one epoch late 
+    overlap = config['overlap_validation']
+    session_config = None 
+    if overlap:
+        evaluator = SnapshotEvaluator()
+        train_threads = max(1, os.cpu_count() - evaluator.n_threads)
+        session_config = tf.ConfigProto(intra_op_parallelism_threads=train_threads, \
+            inter_op_parallelism_threads=train_threads)
+        pending = None # (epoch, snapshot, future)
+        best_snapshot = None 
+
+    # resource telemetry (wall time, steps/sec, rss, cpu, tf allocator) per epoch 
+    if config['telemetry']:
+        sampler = ResourceSampler().start()
+        allocator_op = allocator_bytes_op()
+    run_telemetry = []
+
+    with tf.Session(config=session_config) as sess, contextlib.ExitStack() as cleanup: 
+        if overlap: 
+            # also on errors, so the eval thread + session do not leak 
+            cleanup.callback(evaluator.close)
+        if config['telemetry']: 
+            cleanup.callback(sampler.stop)
         best_sess = sess
         best_score = 0. 
 
         sess.run([tf.global_variables_initializer(), \
             tf.local_variables_initializer()])
 
+        def resolve(pending):
+            nonlocal best_score, best_snapshot, last_improvement
+            epoch, snapshot, future = pending
+            result = future.result()
+            writer.write({'val_loss': result['loss'], 'val_acc': result['acc']}, epoch)
+            print('{}: val acc: {:.2f}'.format(epoch, result['acc']))
+            # (the first snapshot even at 0 acc, test always has one to score)
+            if best_snapshot is None or result['acc'] > best_score:
+                best_snapshot = snapshot
+                best_score = result['acc']
+                last_improvement = 0
+            else:
+                last_improvement += 1
+            return last_improvement > require_improvement
+
+        def epoch_telemetry(steps_per_sec):
+            nonlocal allocator_op
+            if not config['telemetry']: 
+                return {}
+            t = sampler.end()
+            t['steps_per_sec'] = steps_per_sec
+            if allocator_op is not None: 
+                try: 
+                    t['tf_max_bytes_in_use'] = sess.run(allocator_op)
+                except tf.errors.OpError: 
+                    allocator_op = None # no kernel for this device 
+            run_telemetry.append(t)
+            return t
+
         for e in range(config['epochs']):
             metrics = init_metrics()
+            if config['telemetry']: 
+                sampler.begin()
+            train_start = time.perf_counter()
             
             # training 
             sess.run(trainer.acc_initializer) # reset accuracy metric
             sess.run(trainer.iterator_init, \
                 feed_dict={trainer.x_data: x_train, trainer.y_data: y_train})
+            step = 0 
             try: 
                 while True:
                     _, loss, _ = \
                         sess.run([trainer.train_op, trainer.loss,\
                             trainer.acc_op])  
                     metrics['train_loss'].append(loss)
+
+                    # gradient accumulation (large-batch mode)
+                    step += 1
+                    if trainer.accumulation_steps > 1 and step % trainer.accumulation_steps == 0:
+                        sess.run(trainer.apply_op)
                     if trial_run: break 
             except tf.errors.OutOfRangeError: pass 
+            # apply the epoch's leftover micro-batches instead of carrying them over 
+            leftover = step % trainer.accumulation_steps
+            if leftover: 
+                sess.run(trainer.apply_op, feed_dict={trainer.flush_scale: trainer.accumulation_steps / leftover})
             train_acc = sess.run(trainer.acc)
             metrics['train_acc'] = [train_acc]
+            steps_per_sec = len(metrics['train_loss']) / (time.perf_counter() - train_start)
+
+            if overlap: 
+                snapshot = get_layer_weights(sess, trainer.get_inference_layers())
+                future = evaluator.submit(snapshot, x_val, y_val, sess.run(trainer.reg_loss))
+                writer.write(dict({'train_loss': np.mean(metrics['train_loss']), 'train_acc': train_acc}, \
+                    **epoch_telemetry(steps_per_sec)), e)
+                print('{}: {:.2f} acc: {:.2f}'.format(e, np.mean(metrics['train_loss']), train_acc))
+
+                stop = resolve(pending) if pending is not None else False 
+                pending = (e, snapshot, future)
+                if stop: 
+                    print('Early stopping...')
+                    break 
+                continue 
 
             # validation 
             try: 
@@ -105,6 +197,7 @@ def train(trainer):
                 stop = True
 
             epoch_metrics = mean_over_dict(metrics)
+            epoch_metrics.update(epoch_telemetry(steps_per_sec))
             writer.write(epoch_metrics, e)
 
             print('{}: {:.2f} acc: {:.2f} {:.2f}'.format(e, epoch_metrics['train_loss'], train_acc, val_acc))
@@ -114,94 +207,136 @@ def train(trainer):
                 break 
 
         # test set 
-        try: 
-            sess = best_sess # restore session with the best score
-            sess.run(trainer.acc_initializer) # reset accuracy metric
-            sess.run(trainer.iterator_init, feed_dict={
-                trainer.x_data: x_test, 
-                trainer.y_data: y_test, 
-                trainer.is_training: False})
-            while True:
-                _ = sess.run([trainer.acc_op])
-                if trial_run: break 
-        except tf.errors.OutOfRangeError: pass 
-        test_acc = sess.run(trainer.acc)
+        if overlap: 
+            # resolve the last snapshot, then test the best snapshot 
+            if not stop and pending is not None: 
+                resolve(pending)
+            # (queued behind any in-flight validation, they share the eval session)
+            test_acc = evaluator.submit(best_snapshot, x_test, y_test).result()['acc']
+        else: 
+            try: 
+                sess = best_sess # restore session with the best score
+                sess.run(trainer.acc_initializer) # reset accuracy metric
+                sess.run(trainer.iterator_init, feed_dict={
+                    trainer.x_data: x_test, 
+                    trainer.y_data: y_test, 
+                    trainer.is_training: False})
+                while True:
+                    _ = sess.run([trainer.acc_op])
+                    if trial_run: break 
+            except tf.errors.OutOfRangeError: pass 
+            test_acc = sess.run(trainer.acc)
         writer.write({'test_acc': test_acc}, e+1)
 
-    return trainer
-
-#%%
-trial_run = True
-config = {
-    'batch_size': 32 if not trial_run else 2,
-    'epochs': 200 if not trial_run else 1,
-    'reg_constant': 0.001,
-    'dropout_constant': 0.3,
-    'dense_regularization': True, 
-    'kernel_regularization': True 
-}
-
-(x_train, y_train), (x_val, y_val), (x_test, y_test) = get_train_test()
-
-# trainers = [Baseline]
-# configs = [config.copy()]
-
-print('Setting up configs...')
-trainers = []
-configs = []
-
-dropout_config1 = config.copy()
-dropout_config1['dropout_constant'] = 0.3
-dropout_config2 = config.copy()
-dropout_config2['dropout_constant'] = 0.5
-trainers += [Dropout, Dropout] 
-configs += [dropout_config1, dropout_config2]
-
-# orthog_config = config.copy()
-# orthog_config['reg_constant'] = 0.0001
-# trainers.append(OrthogonalReg)
-# configs.append(orthog_config)
-
-# l1_config = config.copy()
-# l1_config['reg_constant'] = 1e-4
-# l2_config = config.copy()
-# l2_config['reg_constant'] = 1e-3
-
-spectral_conf = config.copy()
-spectral_conf['reg_constant'] = 0.01
-trainers += [SpectralReg]
-configs += [spectral_conf]
-
-# trainers += [L1Reg, L2Reg, SpectralReg]
-# configs += [l1_config, l2_config, spectral_conf]
-
-# # include kernel + dense regularization 
-# new_trainers = []
-# new_configs = []
-# for trainer_class, conf in zip(trainers, configs):
-#     if trainer_class.__name__ not in ['Dropout', 'Baseline']:    
-#         d_config = conf.copy()
-#         k_config = conf.copy()
-#         d_config['kernel_regularization'] = False 
-#         k_config['dense_regularization'] = False 
-
-#         new_trainers += [trainer_class] * 2
-#         new_configs += [d_config, k_config]
-# trainers += new_trainers
-# configs += new_configs
-
-# # if trial_run:
-# trainers = [OrthogonalReg]
-# configs = [config]
-
-writer = NeptuneWriter('gebob19/672-cifar')
-
-for config, trainer_class in zip(configs, trainers): 
+        if config['telemetry']:
+            sampler.stop()
+        result = dict({'test_acc': float(test_acc)}, **summarize(run_telemetry))
+
+        # prune + export dense layers as csr and benchmark sparse inference 
+        if config['sparse_thresholds']:
+            specs = get_layer_weights(sess, trainer.get_inference_layers())
+            rows = sparse_report(specs, x_test, y_test, config['sparse_thresholds'], \
+                config['export_dir'])
+            for i, row in enumerate(rows[1:]):
+                writer.write({
+                    'sparse_threshold': row['threshold'],
+                    'sparse_acc': row['acc'], 
+                    'sparse_ms_per_sample': row['ms_per_sample'], 
+                    'sparse_size_ratio': row['size_ratio']}, i)
+
+        # truncated svd of dense + flattened conv kernels (spectral / orthogonal runs)
+        if config['lowrank_energies']:
+            specs = get_layer_weights(sess, trainer.get_inference_layers())
+            rows = lowrank_report(specs, x_test, y_test, config['lowrank_energies'])
+            for i, row in enumerate(rows[1:]):
+                writer.write({
+                    'lowrank_energy': row['energy'],
+                    'lowrank_acc': row['acc'], 
+                    'lowrank_ms_per_sample': row['ms_per_sample'], 
+                    'lowrank_size_ratio': row['size_ratio']}, i)
+
+        # frozen inference-only graph for serve.py 
+        if config['serve_export_dir']:
+            export_frozen(sess, trainer, '{}/{}.pb'.format(config['serve_export_dir'], config['experiment_name']))
+
+    return result
+
+def run_experiment(trainer_class, config, data, writer, trial_run=False):
     config['experiment_name'] = trainer_class.__name__
     if not trial_run:
         writer.start(config)
 
     tf.reset_default_graph()
-    full_trainer = train(trainer_class(config))
+    if config['num_workers'] > 1:
+        result = train_data_parallel(trainer_class, config, data, config['num_workers'], writer, trial_run)
+    else:
+        result = train(trainer_class(config), config, data, writer, trial_run)
     
     writer.fin()
+    return result
+
+#%%
+if __name__ == '__main__':
+    # see cli.py for sweep specs / planning / resuming 
+    trial_run = True
+    config = cifar_config(trial_run)
+
+    data = get_train_test()
+
+    # trainers = [Baseline]
+    # configs = [config.copy()]
+
+    print('Setting up configs...')
+    trainers = []
+    configs = []
+
+    dropout_config1 = config.copy()
+    dropout_config1['dropout_constant'] = 0.3
+    dropout_config2 = config.copy()
+    dropout_config2['dropout_constant'] = 0.5
+    trainers += [Dropout, Dropout] 
+    configs += [dropout_config1, dropout_config2]
+
+    # orthog_config = config.copy()
+    # orthog_config['reg_constant'] = 0.0001
+    # trainers.append(OrthogonalReg)
+    # configs.append(orthog_config)
+
+    # l1_config = config.copy()
+    # l1_config['reg_constant'] = 1e-4
+    # l1_config['sparse_thresholds'] = [1e-4, 1e-3, 1e-2]
+    # l2_config = config.copy()
+    # l2_config['reg_constant'] = 1e-3
+
+    spectral_conf = config.copy()
+    spectral_conf['reg_constant'] = 0.01
+    # spectral_conf['lowrank_energies'] = [0.9, 0.95, 0.99]
+    trainers += [SpectralReg]
+    configs += [spectral_conf]
+
+    # trainers += [L1Reg, L2Reg, SpectralReg]
+    # configs += [l1_config, l2_config, spectral_conf]
+
+    # # include kernel + dense regularization 
+    # new_trainers = []
+    # new_configs = []
+    # for trainer_class, conf in zip(trainers, configs):
+    #     if trainer_class.__name__ not in ['Dropout', 'Baseline']:    
+    #         d_config = conf.copy()
+    #         k_config = conf.copy()
+    #         d_config['kernel_regularization'] = False 
+    #         k_config['dense_regularization'] = False 
+
+    #         new_trainers += [trainer_class] * 2
+    #         new_configs += [d_config, k_config]
+    # trainers += new_trainers
+    # configs += new_configs
+
+    # # if trial_run:
+    # trainers = [OrthogonalReg]
+    # configs = [config]
+
+    writer = NeptuneWriter('gebob19/672-cifar')
+
+    for config, trainer_class in zip(configs, trainers): 
+        run_experiment(trainer_class, config, data, writer, trial_run)
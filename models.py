@@ -1,13 +1,107 @@
 import tensorflow.compat.v1 as tf 
 import numpy as np 
 
+from layer_ops import layer_config, apply_layer
+
+# %%
+# bfloat16 mixed precision: probe once whether this cpu / tf build has
+# bf16 kernels for the ops the conv models use, forward and backward 
+_bfloat16_supported = None
+
+def bfloat16_supported():
+    global _bfloat16_supported
+    if _bfloat16_supported is None:
+        with tf.Graph().as_default():
+            inputs = [tf.ones([1, 8, 8, 3], tf.bfloat16), tf.ones([3, 3, 3, 4], tf.bfloat16), 
+                tf.ones([4], tf.bfloat16), tf.ones([64, 10], tf.bfloat16)]
+            x, kernel, bias, dense = inputs
+            x = tf.nn.conv2d(x, kernel, strides=[1, 1, 1, 1], padding='SAME')
+            x = tf.nn.relu(tf.nn.bias_add(x, bias))
+            x = tf.nn.max_pool(x, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
+            x = tf.nn.softmax(tf.reshape(x, [1, -1]) @ dense)
+            # Conv2DBackpropFilter/Input, MaxPoolGrad, BiasAddGrad, ReluGrad, MatMul
+            grads = tf.gradients(tf.reduce_sum(x), inputs)
+            try: 
+                with tf.Session() as sess:
+                    sess.run([x, grads])
+                _bfloat16_supported = True 
+            except (tf.errors.InvalidArgumentError, tf.errors.NotFoundError, tf.errors.UnimplementedError):
+                _bfloat16_supported = False 
+    return _bfloat16_supported
+
+# %%
+# batch-level augmentation (vectorized over the batch, runs inside tf.data)
+def random_crop(x, padding):
+    b = tf.shape(x)[0]
+    h, w = x.shape.as_list()[1:3]
+    x = tf.pad(x, [[0, 0], [padding, padding], [padding, padding], [0, 0]])
+
+    # per-example offsets into the padded image 
+    oy = tf.random.uniform([b], 0, 2 * padding + 1, dtype=tf.int32)
+    ox = tf.random.uniform([b], 0, 2 * padding + 1, dtype=tf.int32)
+    rows = oy[:, None] + tf.range(h)[None]
+    cols = ox[:, None] + tf.range(w)[None]
+    x = tf.gather(x, rows, axis=1, batch_dims=1)
+    x = tf.gather(x, cols, axis=2, batch_dims=1)
+    return x 
+
+def random_flip(x):
+    flip = tf.random.uniform([tf.shape(x)[0]]) < 0.5
+    return tf.where(flip, tf.reverse(x, [2]), x)
+
+def cutout(x, size):
+    b = tf.shape(x)[0]
+    h, w = x.shape.as_list()[1:3]
+    cy = tf.random.uniform([b, 1, 1], 0, h, dtype=tf.int32) - size // 2
+    cx = tf.random.uniform([b, 1, 1], 0, w, dtype=tf.int32) - size // 2
+    ys = tf.range(h)[None, :, None]
+    xs = tf.range(w)[None, None, :]
+    mask = (ys >= cy) & (ys < cy + size) & (xs >= cx) & (xs < cx + size)
+    return x * (1. - tf.cast(mask, x.dtype)[..., None])
+
+# %%
+# closed-form gradients of the norm penalties, fused over all regularized kernels 
+# (instead of kernel_regularizer -> layer.losses -> autodiff per layer).
+# each returns (gradients, penalty value summed over the kernels)
+def l1_reg_grads(kernels, c):
+    # d/dW c * |W|_1 = c * sign(W), one op over the concatenated kernels 
+    flat = tf.concat([tf.reshape(W, [-1]) for W in kernels], 0)
+    grads = tf.split(c * tf.sign(flat), [W.shape.num_elements() for W in kernels])
+    grads = [tf.reshape(g, W.shape) for g, W in zip(grads, kernels)]
+    return grads, c * tf.reduce_sum(tf.abs(flat))
+
+def l2_reg_grads(kernels, c):
+    # d/dW c * |W|_2 = c * W / |W|_2, the per-kernel norms stacked into one vector 
+    norms = tf.stack([tf.norm(W) for W in kernels])
+    scales = tf.unstack(c / norms)
+    return [W * s for W, s in zip(kernels, scales)], c * tf.reduce_sum(norms)
+
+def orthogonal_reg_grads(kernels, c):
+    # d/dW c * sum|W W^T - I| = 2c * sign(W W^T - I) W (kernels flattened to [-1, out])
+    grads, penalty = [], 0.
+    for W in kernels:
+        W2 = tf.reshape(W, [-1, W.shape[-1]])
+        A = W2 @ tf.transpose(W2) - tf.eye(W2.shape.as_list()[0])
+        grads.append(tf.reshape(2. * c * (tf.sign(A) @ W2), W.shape))
+        penalty += c * tf.reduce_sum(tf.abs(A))
+    return grads, penalty
+
 # %%
 class Baseline():
     def __init__(self, config):
-        self.optimizer = tf.train.AdamOptimizer(1e-4)
+        self.batch_size = config['batch_size']
+        self.accumulation_steps = config['accumulation_steps']
+        self.decoupled_weight_decay = config['decoupled_weight_decay']
+        self.global_step = tf.train.get_or_create_global_step()
+        self.learning_rate = self.get_learning_rate(config)
+        self.optimizer = tf.train.AdamOptimizer(self.learning_rate)
         self.loss_func = tf.keras.losses.CategoricalCrossentropy(from_logits=True)
         self.is_training = tf.placeholder_with_default(True, shape=())
-        self.batch_size = config['batch_size']
+        self.compute_dtype = self.get_compute_dtype(config)
+        self.augmentation = config['augmentation']
+        self.crop_padding = config['crop_padding']
+        self.flip = config['flip']
+        self.cutout_size = config['cutout_size']
         self.layers = self.get_layers(config)
         self.layer_regularization = self.get_layer_regularization_flag() 
 
@@ -16,6 +110,31 @@ class Baseline():
     def get_layer_regularization_flag(self):
         return False 
 
+    def get_compute_dtype(self, config):
+        if not config['mixed_precision']:
+            return tf.float32
+        if not bfloat16_supported():
+            print('Warning: no bfloat16 kernels on this cpu / tf build - using float32')
+            return tf.float32
+        return tf.bfloat16
+
+    def get_learning_rate(self, config):
+        # scale the lr (tuned at base_batch_size) to the effective batch size 
+        # (data-parallel workers pass the global batch, see distributed.worker)
+        batch_size = config.get('global_batch_size', self.batch_size)
+        scale = batch_size * self.accumulation_steps / config['base_batch_size']
+        lr = config['learning_rate']
+        if config['lr_scaling'] == 'linear':
+            lr *= scale
+        elif config['lr_scaling'] == 'sqrt':
+            lr *= np.sqrt(scale)
+
+        # linear warmup over the first optimizer updates 
+        if config['warmup_steps'] > 0:
+            step = tf.cast(self.global_step, tf.float32)
+            lr = lr * tf.minimum(1., (step + 1.) / config['warmup_steps'])
+        return lr
+
     def get_layers(self, config): 
         return [
             tf.keras.layers.Conv2D(64, 7, strides=(2, 2), activation="relu", padding='same'),
@@ -39,19 +158,56 @@ class Baseline():
         ]
     
     def model(self, x):
+        x = tf.cast(x, self.compute_dtype)
         for layer in self.layers: 
-            x = layer(x)
-        return x 
+            x = self.call_layer(layer, x)
+        return tf.cast(x, tf.float32)
+
+    def call_layer(self, layer, x, **kwargs):
+        if self.compute_dtype == tf.float32: 
+            return layer(x, **kwargs)
+
+        kind = type(layer).__name__
+        if kind == 'Dropout':
+            return tf.cast(layer(tf.cast(x, tf.float32), **kwargs), self.compute_dtype)
+
+        # float32 master weights (and their kernel_regularizer penalties) 
+        # are created by build, the forward pass uses bf16 copies 
+        if not layer.built: 
+            with tf.name_scope(layer.name):
+                layer.build(x.shape)
+        params = [tf.cast(w, self.compute_dtype) for w in layer.weights]
+        return apply_layer(x, kind, layer_config(layer), params)
+
+    def get_inference_layers(self):
+        # layers in the order model() applies them 
+        return self.layers
 
     def build_datapipeline(self):
         self.x_data = tf.placeholder(np.float32, [None, 32, 32, 3])
         self.y_data = tf.placeholder(np.float32, [None, 10])
         dataset = tf.data.Dataset.from_tensor_slices((self.x_data, self.y_data))\
             .batch(self.batch_size)
+        if self.augmentation: 
+            dataset = dataset.map(self.augment, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
         self.dataset_iterator = tf.data.Iterator.from_structure(dataset.output_types,
                                                   dataset.output_shapes)
         self.iterator_init = self.dataset_iterator.make_initializer(dataset)
+
+    def augment(self, xb, yb):
+        def augment_batch():
+            x = xb
+            if self.crop_padding: 
+                x = random_crop(x, self.crop_padding)
+            if self.flip: 
+                x = random_flip(x)
+            if self.cutout_size: 
+                x = cutout(x, self.cutout_size)
+            return x 
+        # is_training is fed with the iterator initializer (False for val/test)
+        return tf.cond(self.is_training, augment_batch, lambda: xb), yb
     
     def build_graph(self):
         self.build_datapipeline()
@@ -63,15 +219,70 @@ class Baseline():
         self.loss = self.loss_func(yb, self.logits)
 
         # add layer losses (L1, L2, etc.)
+        self.reg_loss = tf.constant(0.)
         if self.layer_regularization: 
             for layer in self.layers: 
-                self.loss += tf.math.reduce_sum(layer.losses)
+                self.reg_loss += tf.math.reduce_sum(layer.losses)
+        # closed-form penalties (OrthogonalReg family, analytic_reg_grads): their 
+        # gradients are added in build_train_op, the value is only logged 
+        self.reg_grads, analytic_reg_loss = self.get_reg_grads()
+        self.reg_loss += tf.stop_gradient(analytic_reg_loss)
+        self.loss += self.reg_loss
 
         self.acc, self.acc_op = tf.metrics.accuracy(tf.argmax(yb, 1), tf.argmax(self.logits, 1), name='acc')
         self.acc_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="acc")
         self.acc_initializer = tf.variables_initializer(var_list=self.acc_vars)
 
-        self.train_op = self.optimizer.minimize(self.loss)
+        grads = tf.gradients(self.loss, tf.trainable_variables())
+        self.build_train_op(grads, tf.trainable_variables())
+
+    def get_reg_grads(self):
+        # [(variable name, closed-form penalty gradient)] + penalty value, see OrthogonalReg 
+        return [], tf.constant(0.)
+
+    def build_train_op(self, grads, variables):
+        reg_grads = dict(self.reg_grads)
+        decay = []
+        if self.decoupled_weight_decay: 
+            decay = [(v, reg_grads[v.name]) for v in variables if v.name in reg_grads]
+        else: 
+            grads = [g + reg_grads[v.name] if v.name in reg_grads else g for g, v in zip(grads, variables)]
+
+        # kept for data-parallel training (distributed.py) 
+        self.grads = grads
+        self.train_variables = variables
+
+        if self.accumulation_steps == 1:
+            self.train_op = self.apply_gradients(grads, variables, decay)
+            self.apply_op = tf.no_op()
+            return 
+
+        # gradient accumulation: train_op adds the micro-batch gradients, 
+        # apply_op (run every accumulation_steps) applies their mean and resets. 
+        # a partial accumulation of k micro-batches (end of an epoch) is applied 
+        # with flush_scale = accumulation_steps / k so it is still their mean 
+        self.flush_scale = tf.placeholder_with_default(1., shape=())
+        with tf.variable_scope('grad_accumulation'):
+            accumulators = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False) \
+                for v in variables]
+        self.train_op = tf.group([a.assign_add(g / self.accumulation_steps) \
+            for a, g in zip(accumulators, grads)])
+
+        apply = self.apply_gradients([a.read_value() * self.flush_scale for a in accumulators], \
+            variables, decay)
+        with tf.control_dependencies([apply]):
+            self.apply_op = tf.group([a.assign(tf.zeros_like(a)) for a in accumulators])
+
+    def apply_gradients(self, grads, variables, decay=[]):
+        if not decay: 
+            return self.optimizer.apply_gradients(zip(grads, variables), global_step=self.global_step)
+
+        # decoupled (AdamW style): the penalty step bypasses adam's moments, 
+        # W -= lr * penalty_grad(W) with W read before the adam update 
+        with tf.control_dependencies([g for _, g in decay]):
+            apply = self.optimizer.apply_gradients(zip(grads, variables), global_step=self.global_step)
+        with tf.control_dependencies([apply]):
+            return tf.group([v.assign_sub(self.learning_rate * g) for v, g in decay])
 
 class Dropout(Baseline):
     def __init__(self, config):
@@ -100,15 +311,19 @@ class Dropout(Baseline):
         ]
     
     def model(self, x):
+        x = tf.cast(x, self.compute_dtype)
         for layer in self.layers: 
-            x = layer(x)
-        x = self.dropout(x, training=self.is_training)
+            x = self.call_layer(layer, x)
+        x = self.call_layer(self.dropout, x, training=self.is_training)
         
-        x = self.flatten(x)
-        x = self.dense1(x)
-        x = self.dense2(x)
-        x = self.dense3(x)
-        return x 
+        x = self.call_layer(self.flatten, x)
+        x = self.call_layer(self.dense1, x)
+        x = self.call_layer(self.dense2, x)
+        x = self.call_layer(self.dense3, x)
+        return tf.cast(x, tf.float32)
+
+    def get_inference_layers(self):
+        return self.layers + [self.dropout, self.flatten, self.dense1, self.dense2, self.dense3]
 
 class SpectralReg(Baseline):
     def __init__(self, config):
@@ -122,6 +337,8 @@ class SpectralReg(Baseline):
         xb, yb = self.dataset_iterator.get_next()
         logits = self.model(xb)
         self.loss = self.loss_func(yb, logits)
+        self.reg_loss = tf.constant(0.) # applied directly to the gradients below 
+        self.reg_grads = []
 
         self.variables = [(v, i) for i, v in enumerate(tf.trainable_variables()) if 'dense' in v.name]
         # dont apply to last dense layer 
@@ -151,16 +368,42 @@ class SpectralReg(Baseline):
         self.acc_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="acc")
         self.acc_initializer = tf.variables_initializer(var_list=self.acc_vars)
 
-        self.train_op = self.optimizer.apply_gradients(zip(grads, tf.trainable_variables()))
+        self.build_train_op(grads, tf.trainable_variables())
 
 class OrthogonalReg(Baseline):
     def __init__(self, config):
         self.reg_constant = config['reg_constant']
         self.set_reg_method(config)
+
+        # analytic mode: no kernel_regularizer, the penalty gradients are added 
+        # in build_train_op and its value is logged in reg_loss (not differentiated)
+        self.analytic_reg_grads = config['analytic_reg_grads'] or config['decoupled_weight_decay']
+        self.dense_reg_flag = self.dense_reg_method is not None
+        self.kernel_reg_flag = self.kernel_reg_method is not None
+        if self.analytic_reg_grads: 
+            self.dense_reg_method = self.kernel_reg_method = None
         super().__init__(config)
 
     def get_layer_regularization_flag(self):
-        return True
+        return not self.analytic_reg_grads
+
+    def get_reg_grads(self):
+        kernels = self.get_regularized_kernels() if self.analytic_reg_grads else []
+        if not kernels: 
+            return super().get_reg_grads()
+        grads, penalty = self.reg_grad_method(kernels, self.reg_constant)
+        return [(W.name, g) for W, g in zip(kernels, grads)], penalty
+
+    def get_regularized_kernels(self):
+        # same kernels get_layers attaches kernel_regularizer to (not the last dense)
+        dense_layers = [l for l in self.layers if isinstance(l, tf.keras.layers.Dense)][:-1]
+        kernels = []
+        for layer in self.layers: 
+            if isinstance(layer, tf.keras.layers.Conv2D) and self.kernel_reg_flag: 
+                kernels.append(layer.kernel)
+            if layer in dense_layers and self.dense_reg_flag: 
+                kernels.append(layer.kernel)
+        return kernels
 
     def set_reg_method(self, config):
         def orthogonal_reg(W):
@@ -188,6 +431,7 @@ class OrthogonalReg(Baseline):
 
         self.dense_reg_method = orthogonal_reg if config['dense_regularization'] else None
         self.kernel_reg_method = orthogonal_flat_kernel_reg if config['kernel_regularization'] else None
+        self.reg_grad_method = orthogonal_reg_grads
 
     def get_layers(self, config):
         return [
@@ -221,6 +465,7 @@ class L2Reg(OrthogonalReg):
             return self.reg_constant * norm
         self.dense_reg_method = L2_reg if config['dense_regularization'] else None
         self.kernel_reg_method = L2_reg if config['kernel_regularization'] else None
+        self.reg_grad_method = l2_reg_grads
 
 class L1Reg(OrthogonalReg):
     def __init__(self, config):
@@ -231,4 +476,5 @@ class L1Reg(OrthogonalReg):
             norm = tf.norm(W, 1)
             return self.reg_constant * norm
         self.dense_reg_method = L1_reg if config['dense_regularization'] else None
-        self.kernel_reg_method = L1_reg if config['kernel_regularization'] else None
\ No newline at end of file
+        self.kernel_reg_method = L1_reg if config['kernel_regularization'] else None
+        self.reg_grad_method = l1_reg_grads
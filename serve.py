@@ -0,0 +1,222 @@
+import tensorflow.compat.v1 as tf
+import numpy as np
+import argparse
+import collections
+import http.server
+import json
+import os
+import pathlib
+import queue
+import socketserver
+import threading
+import time
+
+from layer_ops import get_layer_weights, build_inference_graph
+
+# frozen inference-only export + local batched inference server (CPU, offline)
+# export (inside the training session):
+#   export_frozen(sess, trainer, 'exports/L1Reg.pb')
+# serve:
+#   python serve.py exports/L1Reg.pb --port 8000 --max-batch-size 64 --max-latency-ms 5
+#   curl -d '{"instances": [...]}' localhost:8000/predict
+#   curl localhost:8000/stats
+
+INPUT_NAME = 'input'
+OUTPUT_NAME = 'probs'
+
+#%%
+def export_frozen(sess, trainer, path):
+    # weights are baked in as constants, no iterator / is_training placeholder
+    specs = get_layer_weights(sess, trainer.get_inference_layers())
+    input_shape = trainer.x_data.shape.as_list()[1:]
+    with tf.Graph().as_default() as graph:
+        x = tf.placeholder(tf.float32, [None] + input_shape, name=INPUT_NAME)
+        tf.identity(build_inference_graph(x, specs), name=OUTPUT_NAME)
+    path = pathlib.Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tf.io.write_graph(graph.as_graph_def(), str(path.parent), path.name, as_text=False)
+
+def load_frozen(path):
+    graph_def = tf.GraphDef()
+    with open(str(path), 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+    return graph
+
+#%%
+class BatchedModel:
+    def __init__(self, path, max_batch_size=64, max_latency_ms=5., n_latencies=100000):
+        self.graph = load_frozen(path)
+        self.x = self.graph.get_tensor_by_name(INPUT_NAME + ':0')
+        self.probs = self.graph.get_tensor_by_name(OUTPUT_NAME + ':0')
+        self.sess = tf.Session(graph=self.graph)
+
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=n_latencies)
+        self.batch_sizes = collections.deque(maxlen=n_latencies)
+        self.reset_stats()
+
+        self.batch_thread = threading.Thread(target=self._batch_loop, daemon=True)
+        self.batch_thread.start()
+
+    def predict(self, x):
+        # bad input is rejected here so it never reaches (and fails) a shared batch
+        x = np.asarray(x, dtype=np.float32)
+        input_shape = tuple(self.x.shape.as_list()[1:])
+        if x.ndim != len(input_shape) + 1 or x.shape[1:] != input_shape or len(x) == 0:
+            raise ValueError('instances must have shape [n > 0, {}], got {}'.format(
+                ', '.join(map(str, input_shape)), list(x.shape)))
+        request = {'x': x, 'start': time.perf_counter(), 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['probs']
+
+    def _batch_loop(self):
+        while True:
+            # wait for the first request then fill the batch until it is full
+            # or the oldest request hits the latency bound
+            batch = [self.requests.get()]
+            n = len(batch[0]['x'])
+            deadline = batch[0]['start'] + self.max_latency
+            while n < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0: break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty: break
+                batch.append(request)
+                n += len(request['x'])
+
+            try:
+                probs = self.sess.run(self.probs,
+                    feed_dict={self.x: np.concatenate([r['x'] for r in batch])})
+            except Exception as e:
+                for r in batch:
+                    r['error'] = e
+                    r['done'].set()
+                continue
+
+            i = 0
+            end = time.perf_counter()
+            for r in batch:
+                r['probs'] = probs[i:i+len(r['x'])]
+                i += len(r['x'])
+                self.latencies.append(end - r['start'])
+                r['done'].set()
+            self.batch_sizes.append(n)
+            self.n_samples += n
+            self.n_requests += len(batch)
+
+    def reset_stats(self):
+        self.latencies.clear()
+        self.batch_sizes.clear()
+        self.n_samples = 0
+        self.n_requests = 0
+        self.stats_start = time.perf_counter()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.stats_start
+        latencies = np.array(self.latencies) * 1000.
+        return {
+            'requests': self.n_requests,
+            'samples': self.n_samples,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'requests_per_sec': self.n_requests / elapsed,
+            'samples_per_sec': self.n_samples / elapsed,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) else None,
+        }
+
+#%%
+def make_handler(model):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            body = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, model.stats())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'not found'})
+                return
+            try:
+                data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                probs = model.predict(data['instances'])
+            except Exception as e:
+                self._reply(400, {'error': str(e)})
+                return
+            self._reply(200, {'probs': probs.tolist(), 'classes': np.argmax(probs, 1).tolist()})
+
+        # unix sockets have no (host, port) client address
+        def address_string(self):
+            return str(self.client_address)
+
+        def log_message(self, *args): pass
+    return Handler
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(model, port=8000, host='127.0.0.1', socket_path=None):
+    handler = make_handler(model)
+    if socket_path is not None:
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+#%%
+def benchmark(model, x, n_requests=1000, concurrency=16, request_size=1):
+    # closed-loop load generator calling the batcher in-process
+    model.predict(x[:request_size]) # warmup
+    model.reset_stats()
+
+    def client(n):
+        for i in range(n):
+            j = np.random.randint(0, len(x) - request_size + 1)
+            model.predict(x[j:j+request_size])
+
+    # the remainder is spread over the first threads so exactly n_requests are sent
+    counts = [n_requests // concurrency + (i < n_requests % concurrency) for i in range(concurrency)]
+    threads = [threading.Thread(target=client, args=(n,)) for n in counts if n > 0]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return model.stats()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help='frozen graph written by export_frozen')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', default=None, help='serve over a unix socket instead of tcp')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=5.)
+    parser.add_argument('--benchmark', type=int, default=0,
+        help='run N random requests in-process and report latency/throughput instead of serving')
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    model = BatchedModel(args.model, args.max_batch_size, args.max_latency_ms)
+    if args.benchmark:
+        x = np.random.rand(1024, *model.x.shape.as_list()[1:]).astype(np.float32)
+        print(json.dumps(benchmark(model, x, args.benchmark, args.concurrency), indent=2))
+    else:
+        server = make_server(model, args.port, args.host, args.socket)
+        print('Serving on {}'.format(args.socket or '{}:{}'.format(args.host, args.port)))
+        server.serve_forever()
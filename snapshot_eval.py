@@ -0,0 +1,66 @@
+import tensorflow.compat.v1 as tf
+import numpy as np
+import concurrent.futures
+import os
+
+from layer_ops import build_inference_graph
+
+# evaluates weight snapshots (layer_ops.get_layer_weights) in a background thread
+# with its own graph + session, so validation overlaps with the next training epoch.
+#   evaluator = SnapshotEvaluator()
+#   future = evaluator.submit(get_layer_weights(sess, layers), x_val, y_val)
+#   future.result() -> {'loss': ..., 'acc': ...}
+
+class SnapshotEvaluator:
+    def __init__(self, batch_size=256, n_threads=None):
+        self.batch_size = batch_size
+        # small thread budget so validation does not compete with training for every 
+        # core, the training session gets the rest (see main.train)
+        self.n_threads = n_threads or max(1, os.cpu_count() // 4)
+        self.loss_func = tf.keras.losses.CategoricalCrossentropy(from_logits=True)
+        self.graph = None
+        # a single worker keeps evaluations in epoch order
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def build(self, specs, input_shape):
+        # weights live in variables so every snapshot reuses the same graph
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.x = tf.placeholder(tf.float32, [None] + list(input_shape))
+            self.y = tf.placeholder(tf.float32, [None, None])
+            self.weights = []
+            var_specs = []
+            for spec in specs:
+                params = [tf.Variable(tf.zeros(p.shape, p.dtype), trainable=False) for p in spec['params']]
+                self.weights += params
+                var_specs.append(dict(spec, params=params))
+            probs = build_inference_graph(self.x, var_specs)
+            self.loss = self.loss_func(self.y, probs)
+            self.correct = tf.reduce_sum(tf.cast(tf.equal(tf.argmax(probs, 1), tf.argmax(self.y, 1)), tf.float32))
+            self.sess = tf.Session(config=tf.ConfigProto(
+                intra_op_parallelism_threads=self.n_threads, 
+                inter_op_parallelism_threads=self.n_threads))
+
+    def evaluate(self, specs, x, y, reg_loss=0.):
+        if self.graph is None:
+            self.build(specs, x.shape[1:])
+        params = [p for spec in specs for p in spec['params']]
+        for var, value in zip(self.weights, params):
+            var.load(value, self.sess)
+
+        losses, correct = [], 0.
+        for i in range(0, len(x), self.batch_size):
+            loss, c = self.sess.run([self.loss, self.correct], feed_dict={
+                self.x: x[i:i+self.batch_size],
+                self.y: y[i:i+self.batch_size]})
+            losses.append(loss)
+            correct += c
+        return {'loss': np.mean(losses) + reg_loss, 'acc': correct / len(x)}
+
+    def submit(self, specs, x, y, reg_loss=0.):
+        return self.executor.submit(self.evaluate, specs, x, y, reg_loss)
+
+    def close(self):
+        self.executor.shutdown()
+        if self.graph is not None:
+            self.sess.close()
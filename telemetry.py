@@ -0,0 +1,92 @@
+import tensorflow.compat.v1 as tf
+import numpy as np
+import os
+import resource
+import threading
+import time
+
+# per-epoch resource telemetry logged next to the loss / accuracy channels
+#   sampler = ResourceSampler().start()
+#   sampler.begin()  ... epoch ...  metrics.update(sampler.end())
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def current_rss():
+    # /proc is cheap to read; fall back to the lifetime peak elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss()
+
+def peak_rss():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def cpu_time():
+    t = os.times()
+    return t.user + t.system
+
+def allocator_bytes_op():
+    # tf allocator high-water mark, None when this build has no memory_stats ops
+    try:
+        from tensorflow.contrib.memory_stats import MaxBytesInUse
+        return MaxBytesInUse()
+    except (ImportError, AttributeError, tf.errors.NotFoundError):
+        return None
+
+class ResourceSampler:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.rss = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.begin()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            rss = current_rss()
+            with self.lock:
+                self.rss.append(rss)
+
+    def begin(self):
+        with self.lock:
+            self.rss = [current_rss()]
+        self.start_time = time.perf_counter()
+        self.start_cpu = cpu_time()
+
+    def end(self):
+        wall_time = time.perf_counter() - self.start_time
+        with self.lock:
+            rss = self.rss + [current_rss()]
+        return {
+            'wall_time': wall_time,
+            # fraction of all cores kept busy by this process
+            'cpu_util': (cpu_time() - self.start_cpu) / wall_time / os.cpu_count(),
+            'rss_mb': np.mean(rss) / 2**20,
+            'max_rss_mb': np.max(rss) / 2**20,
+            # lifetime ru_maxrss: never goes down, so in a long-lived process (cli.py run)
+            # it is the peak of every earlier run too, max_rss_mb is this epoch's 
+            'process_peak_rss_mb': peak_rss() / 2**20,
+        }
+
+def summarize(epochs):
+    # whole-run totals for cost-vs-accuracy tables
+    if not epochs:
+        return {}
+    return {
+        'total_time': float(sum(t['wall_time'] for t in epochs)),
+        'mean_steps_per_sec': float(np.mean([t['steps_per_sec'] for t in epochs])),
+        'mean_cpu_util': float(np.mean([t['cpu_util'] for t in epochs])),
+        # from the per-run samples, not the process lifetime peak 
+        'max_rss_mb': float(max(t['max_rss_mb'] for t in epochs)),
+    }